@@ -0,0 +1,109 @@
+# Parsing of S3 server access log lines.
+#
+# This module is kept free of other project imports and is fully annotated
+# so that it can be compiled with mypyc (see `make mypyc`); when the
+# compiled extension is present next to this file it is imported instead.
+
+from datetime import datetime
+import re
+import sys
+from typing import NamedTuple
+
+
+re_line = re.compile(
+    rb'^[0-9a-f]+ ([^ ]+) \[([0-9A-Za-z:/ +-]+)\] [^ ]+ [^ ]+ [^ ]+ '
+    rb'([^ ]+) ([^ ]+)'
+    rb'.*'
+)
+
+
+class Record(NamedTuple):
+    bucket: str
+    day: str
+    operation: str
+    key: str
+
+
+def parse_line(line: bytes) -> Record:
+    parts = line.split(b' ', 8)
+    if len(parts) == 9 and parts[2].startswith(b'[') and parts[3].endswith(b']'):
+        bucket = parts[1]
+        dt_str = parts[2][1:] + b' ' + parts[3][:-1]
+        operation = parts[7]
+        key = parts[8].split(b' ', 1)[0]
+    else:
+        # slow path for lines that do not split into the expected fields
+        m = re_line.match(line)
+        if not m:
+            raise Exception('Invalid line format')
+        bucket, dt_str, operation, key = m.groups()
+    # day and operation repeat a lot - interning makes the counter key
+    # comparisons cheaper and saves memory
+    return Record(
+        bucket.decode('ascii'),
+        sys.intern(parse_day(dt_str)),
+        sys.intern(operation.decode('ascii')),
+        key.decode('UTF-8'))
+
+
+re_date = re.compile(
+    rb'([0123][0-9])/([A-Z][a-z]{2})/([0-9]{4}):'
+    rb'([012][0-9]):([0-5][0-9]):([0-6][0-9]) ([+-])([0-9]{2})([0-9]{2})'
+)
+
+
+month_names = b'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()
+month_by_name = {name: n for n, name in enumerate(month_names, start=1)}
+assert month_by_name[b'Jan'] == 1
+assert month_by_name[b'Dec'] == 12
+month_number_by_name = {name: b'%02d' % n for name, n in month_by_name.items()}
+
+
+def parse_day(dt_str: bytes) -> str:
+    # returns 'YYYY-MM-DD' - the counter key does not need a full datetime
+    if len(dt_str) == 26 and dt_str[21:26] == b'+0000':
+        month = month_number_by_name.get(dt_str[3:6])
+        if month:
+            return (dt_str[7:11] + b'-' + month + b'-' + dt_str[0:2]).decode('ascii')
+    return parse_date(dt_str).strftime('%Y-%m-%d')
+
+
+def parse_date(dt_str: bytes) -> datetime:
+    # fast path: fixed-width "03/May/2019:02:40:29 +0000"
+    if len(dt_str) == 26 and dt_str[21:26] == b'+0000':
+        try:
+            return datetime(
+                int(dt_str[7:11]), month_by_name[dt_str[3:6]], int(dt_str[0:2]),
+                int(dt_str[12:14]), int(dt_str[15:17]), int(dt_str[18:20]))
+        except (KeyError, ValueError):
+            pass
+    m = re_date.match(dt_str)
+    if not m:
+        raise Exception('Invalid date format: {!r}'.format(dt_str))
+    day, month_name, year, hour, minute, second, tz_sign, tz_hours, tz_minutes = m.groups()
+    if tz_hours != b'00' or tz_minutes != b'00':
+        # never happened, but just to be sure
+        raise Exception('Timezone support other than 0000 not yet implemented :/')
+    return datetime(
+        int(year), month_by_name[month_name], int(day),
+        int(hour), int(minute), int(second))
+
+
+sample_line = (
+    'c8f54323b37925ebe7617174b0e940623caad6e9e798e7f0dc55675743eb04c0 '
+    'edc-data-staging [03/May/2019:02:40:29 +0000] 94.130.17.190 - B9579B47C8F79A37 '
+    'REST.GET.OBJECT edc-s3-mock-data/Cases/ID002 '
+    '"GET /edc-data-staging/edc-s3-mock-data/Cases/ID002 HTTP/1.1" '
+    '200 - 1234 1234 16 15 "-" "python-requests/2.21.0" - '
+    'PwohJhVIBLoSRUrr+D9ElHt/av4XzO86zvIxp27mb5fFMWmKp0uon8DiSFHn63vmSalkc4ZWDdY= - '
+    'ECDHE-RSA-AES128-GCM-SHA256 - s3.eu-central-1.amazonaws.com TLSv1.2'
+)
+
+
+assert parse_line(sample_line.encode('ascii')) == Record(
+    bucket='edc-data-staging',
+    operation='REST.GET.OBJECT',
+    key='edc-s3-mock-data/Cases/ID002',
+    day='2019-05-03')
+
+assert parse_date(b'03/May/2019:02:40:29 +0000') == datetime(2019, 5, 3, 2, 40, 29)
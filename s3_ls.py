@@ -2,10 +2,13 @@
 
 from argparse import ArgumentParser
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 from pathlib import Path
-import re
+from queue import Full, Queue
 import sys
+from threading import Event, Thread, local
+from urllib.parse import urlsplit
 
 
 logger = getLogger(Path(__file__).with_suffix('').name)
@@ -16,29 +19,123 @@ log_format = '%(asctime)s %(name)s %(levelname)5s: %(message)s'
 def main():
     p = ArgumentParser()
     p.add_argument('s3_url')
+    p.add_argument('--threads', type=int, default=16, help='number of prefixes listed concurrently')
     args = p.parse_args()
     setup_logging()
-    m = re.match(r'^s3://([^/]+)(?:/(.*))?', args.s3_url)
-    if not m:
+    try:
+        u = urlsplit(args.s3_url)
+    except ValueError:
         sys.exit('Invalid S3 URL format: ' + args.s3_url)
-    bucket_name, key_prefix = m.groups()
-    key_prefix = key_prefix or ''
+    if u.scheme != 's3' or not u.netloc:
+        sys.exit('Invalid S3 URL format: ' + args.s3_url)
+    bucket_name = u.netloc
+    # take the rest of the URL verbatim - keys may contain '?' or '#'
+    rest = args.s3_url[len('s3://'):]
+    if rest != bucket_name and not rest.startswith(bucket_name + '/'):
+        sys.exit('Invalid S3 URL format: ' + args.s3_url)
+    key_prefix = rest.partition('/')[2]
     logger.debug('bucket_name: %r', bucket_name)
     logger.debug('key_prefix: %r', key_prefix)
+    write = sys.stdout.buffer.write
+    bucket_name_bytes = bucket_name.encode()
+    total_count = 0
+    for contents in list_objects(bucket_name, key_prefix, args.threads):
+        buf = bytearray()
+        for obj in contents:
+            buf += b'%s %s %d %s\n' % (
+                bucket_name_bytes, obj['Key'].encode(), obj['Size'], obj['StorageClass'].encode())
+        write(buf)
+        total_count += len(contents)
+        logger.info('Listed %d objects', total_count)
+    sys.stdout.buffer.flush()
+
+
+def list_objects(bucket_name, key_prefix, thread_count):
+    # List the first level with a delimiter and then list each common prefix
+    # ("subdirectory") in its own thread - S3 request latency is the bottleneck.
     s3_client = boto3.client('s3')
     paginator = s3_client.get_paginator('list_objects_v2')
     page_iterator = paginator.paginate(
         Bucket=bucket_name,
-        Prefix=key_prefix)
-    total_count = 0
+        Prefix=key_prefix,
+        Delimiter='/',
+        PaginationConfig={'PageSize': 1000})
+    prefixes = []
     for page in page_iterator:
-        if not page.get('Contents'):
-            logger.warning('No key Contents in page: %r', page)
-            continue
-        for obj in page['Contents']:
-            print(bucket_name, obj['Key'], obj['Size'], obj['StorageClass'])
-            total_count += 1
-        logger.info('Listed %d objects', total_count)
+        yield page.get('Contents', [])
+        prefixes.extend(cp['Prefix'] for cp in page.get('CommonPrefixes', []))
+    logger.debug('Listing %d prefixes using %d threads', len(prefixes), thread_count)
+    yield from list_prefixes_concurrently(bucket_name, prefixes, thread_count)
+
+
+def list_prefixes_concurrently(bucket_name, prefixes, thread_count):
+    contents_queue = Queue(maxsize=thread_count * 4)
+    stop_event = Event()
+    thread_local = local()
+
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                contents_queue.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    def list_prefix(prefix):
+        if stop_event.is_set():
+            return
+        if not hasattr(thread_local, 's3_client'):
+            # boto3 default session is not thread safe, so create own session
+            thread_local.s3_client = boto3.session.Session().client('s3')
+        paginator = thread_local.s3_client.get_paginator('list_objects_v2')
+        page_iterator = paginator.paginate(
+            Bucket=bucket_name,
+            Prefix=prefix,
+            PaginationConfig={'PageSize': 1000})
+        for page in page_iterator:
+            if stop_event.is_set():
+                return
+            if not page.get('Contents'):
+                logger.warning('No key Contents in page: %r', page)
+                continue
+            put(page['Contents'])
+
+    def run():
+        try:
+            with ThreadPoolExecutor(max_workers=thread_count) as executor:
+                futures = [executor.submit(list_prefix, prefix) for prefix in prefixes]
+                try:
+                    for future in futures:
+                        future.result()
+                        if stop_event.is_set():
+                            # output was closed, do not start listing the remaining prefixes
+                            for f in futures:
+                                f.cancel()
+                            break
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        except BaseException as e:
+            logger.exception('Failed to list objects: %r', e)
+            errors.append(e)
+        finally:
+            put(None)
+
+    errors = []
+    t = Thread(target=run, name='list_prefixes', daemon=True)
+    t.start()
+    try:
+        while True:
+            contents = contents_queue.get()
+            if contents is None:
+                break
+            yield contents
+    finally:
+        stop_event.set()
+        t.join()
+    if errors:
+        raise Exception('Failed to list objects: {!r}'.format(errors[0]))
 
 
 def setup_logging():
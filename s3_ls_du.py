@@ -5,41 +5,40 @@ from collections import defaultdict
 import sys
 
 
+subdir_count_limit = 50
+
+
 def main():
     p = ArgumentParser()
     args = p.parse_args()
     total_usage_by_bucket = defaultdict(Directory)
     process_stream(total_usage_by_bucket, sys.stdin.buffer)
-    for bucket_name, root_directory in sorted(total_usage_by_bucket.items()):
-        root_directory.print_usage(bucket_name)
+    print_usage(total_usage_by_bucket)
 
 
 class Directory:
 
-    subdir_count_limit = 50
+    __slots__ = ('total_bytes', 'subdirectories')
 
     def __init__(self):
-        self.total_bytes = defaultdict(lambda: 0)
+        self.total_bytes = defaultdict(int)
         self.subdirectories = defaultdict(Directory)
 
-    def __repr__(self):
-        return '<{cls} total_bytes={s.total_bytes} subdirectories={s.subdirectories}>'.format(
-            cls=self.__class__.__name__, s=self)
-
-    def update(self, key_parts, storage_class, size):
-        assert isinstance(key_parts, list)
-        self.total_bytes[storage_class] += size
-        if key_parts and len(self.subdirectories) < self.subdir_count_limit:
-            subdir, *rest = key_parts
-            self.subdirectories[subdir].update(rest, storage_class, size)
 
-    def print_usage(self, bucket_name, key=''):
-        for sc_name, sc_bytes in sorted(self.total_bytes.items()):
-            print(bucket_name, key.ljust(60), sc_name, nice_bytes(sc_bytes))
-        if len(self.subdirectories) < self.subdir_count_limit:
-            for subdir_name, subdir in sorted(self.subdirectories.items()):
-                subdir_key = (key + '/' + subdir_name).lstrip('/')
-                subdir.print_usage(bucket_name, subdir_key)
+def print_usage(total_usage_by_bucket):
+    out = []
+    # walk the tree depth first, children in sorted order
+    stack = [(bucket_name, (), d) for bucket_name, d in sorted(total_usage_by_bucket.items(), reverse=True)]
+    while stack:
+        bucket_name, key_parts, d = stack.pop()
+        key = '/'.join(key_parts).lstrip('/').ljust(60)
+        for sc_name, sc_bytes in sorted(d.total_bytes.items()):
+            out.append('{} {} {} {}\n'.format(bucket_name, key, sc_name, nice_bytes(sc_bytes)))
+        # directories with too many subdirectories are printed without them
+        if len(d.subdirectories) < subdir_count_limit:
+            for subdir_name, subdir in sorted(d.subdirectories.items(), reverse=True):
+                stack.append((bucket_name, key_parts + (subdir_name,), subdir))
+    sys.stdout.write(''.join(out))
 
 
 def nice_bytes(v):
@@ -48,11 +47,18 @@ def nice_bytes(v):
 
 def process_stream(total_usage_by_bucket, stream):
     for line in stream:
-        assert isinstance(line, bytes)
         line = line.decode('UTF-8')
         bucket_name, key, size, storage_class = line.split()
         size = int(size)
-        total_usage_by_bucket[bucket_name].update(key.split('/')[:-1], storage_class, size)
+        d = total_usage_by_bucket[bucket_name]
+        d.total_bytes[storage_class] += size
+        for subdir_name in key.split('/')[:-1]:
+            # subdirectories of a directory with too many of them are not printed,
+            # so do not collect them
+            if len(d.subdirectories) >= subdir_count_limit:
+                break
+            d = d.subdirectories[subdir_name]
+            d.total_bytes[storage_class] += size
 
 
 if __name__ == '__main__':
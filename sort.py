@@ -1,13 +1,27 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
 import gzip
 from heapq import merge as heapq_merge
+from io import BufferedWriter, BytesIO
 from itertools import count
 from logging import getLogger
+import multiprocessing
+import os
 from pathlib import Path
+from queue import Queue
+import shutil
+import subprocess
 import sys
 from tempfile import TemporaryDirectory
+from threading import Thread
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 logger = getLogger(Path(__file__).with_suffix('').name)
@@ -15,42 +29,95 @@ logger = getLogger(Path(__file__).with_suffix('').name)
 
 def main():
     p = ArgumentParser()
+    p.add_argument('--python', action='store_true', help='do not use external GNU sort')
+    p.add_argument('--jobs', '-j', type=int, help='number of parallel sort processes')
+    p.add_argument('--chunk-size', type=int, default=1000000,
+        help='number of lines sorted in memory at once (without GNU sort); '
+             'up to jobs + 2 chunks can be held in memory at the same time')
     args = p.parse_args()
     setup_logging()
     with TemporaryDirectory(prefix='sort.') as temp_dir:
         temp_dir = Path(temp_dir)
-        sort(sys.stdin.buffer, sys.stdout.buffer, temp_dir)
+        sort_command = None if args.python else find_gnu_sort()
+        if sort_command:
+            external_sort(sort_command, sys.stdin.buffer, sys.stdout.buffer, temp_dir,
+                jobs=args.jobs)
+        else:
+            sort(sys.stdin.buffer, sys.stdout.buffer, temp_dir,
+                chunk_size=args.chunk_size, jobs=args.jobs)
+
+
+def find_gnu_sort():
+    for name in ['gsort', 'sort']:
+        path = shutil.which(name)
+        if not path:
+            continue
+        try:
+            version = subprocess.run([path, '--version'], stdout=subprocess.PIPE, check=True).stdout
+        except Exception as e:
+            logger.debug('Failed to run %s --version: %r', path, e)
+            continue
+        if b'GNU coreutils' in version:
+            return path
+    return None
+
+
+def external_sort(sort_command, input_stream, output_stream, temp_dir, jobs=None):
+    # LC_ALL=C compares bytes; GNU sort compares lines without the trailing
+    # newline, the Python implementation does the same (see line_sort_key)
+    env = dict(os.environ, LC_ALL='C')
+    cmd = [
+        sort_command,
+        '--buffer-size=2G',
+        '--parallel={}'.format(jobs or os.cpu_count() or 1),
+        '--compress-program={}'.format(get_temp_compression(external=True)),
+        '--temporary-directory={}'.format(temp_dir),
+    ]
+    logger.debug('Running %s', ' '.join(cmd))
+    output_stream.flush()
+    subprocess.run(cmd, stdin=input_stream, stdout=output_stream, env=env, check=True)
 
 
-def sort(input_stream, output_stream, temp_dir):
+def sort(input_stream, output_stream, temp_dir, chunk_size=1000000, jobs=None):
+    jobs = jobs or min(4, os.cpu_count() or 1)
     temp_files = []
-    temp_file_counter = count()
+    compression = get_temp_compression()
+    logger.debug('Using %s for temporary files', compression)
     try:
-        while True:
-            chunk = []
-            for line in input_stream:
-                assert line.endswith(b'\n')
-                chunk.append(line)
-                if len(chunk) >= 1000000:
-                    break
-            if not chunk:
-                break
-            chunk.sort()
-            temp_file_path = temp_dir / '{:06d}.gz'.format(next(temp_file_counter))
-            temp_files.append(temp_file_path)
-            with gzip.open(temp_file_path, mode='wb') as f:
-                for line in chunk:
-                    f.write(line)
-        # ok, have all chunks
-        open_files = []
-        for p in temp_files:
-            open_files.append(gzip.open(p, mode='rb'))
+        # Chunks are sorted in worker processes while the writer thread
+        # compresses already sorted chunks. The queue bounds memory usage:
+        # up to `jobs` queued chunks (being sorted or sorted), plus the one
+        # being compressed and the one being read, so about jobs + 2 chunks.
+        write_queue = Queue(maxsize=jobs)
+        writer_errors = []
+        writer = Thread(
+            target=write_chunks,
+            args=(write_queue, temp_dir, temp_files, compression, writer_errors),
+            name='write_chunks')
+        writer.start()
         try:
-            for line in heapq_merge(*open_files):
-                output_stream.write(line)
+            # the worker processes are started lazily while the writer thread
+            # is running, so do not fork them
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=get_mp_context()) as executor:
+                for chunk in iter_chunks(input_stream, chunk_size):
+                    write_queue.put(executor.submit(sort_chunk, chunk))
         finally:
-            for f in open_files:
-                f.close()
+            write_queue.put(None)
+            writer.join()
+        if writer_errors:
+            raise Exception('Failed to write sorted chunk: {!r}'.format(writer_errors[0]))
+        # ok, have all chunks
+        with ExitStack() as stack:
+            open_files = [stack.enter_context(open_temp_file_for_reading(p, compression)) for p in temp_files]
+            write = output_stream.write
+            buf = bytearray()
+            for line in heapq_merge(*[iter_lines(f) for f in open_files], key=line_sort_key):
+                buf += line
+                if len(buf) >= write_block_size:
+                    write(buf)
+                    buf.clear()
+            if buf:
+                write(buf)
         output_stream.flush()
     finally:
         for p in temp_files:
@@ -60,6 +127,159 @@ def sort(input_stream, output_stream, temp_dir):
                 logger.exception('Failed to unlink temporary file %s: %r', p, e)
 
 
+def get_mp_context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def line_sort_key(line):
+    # compare without the newline, like GNU sort - otherwise b'a\tb\n' would
+    # sort before b'a\n', because b'\t' < b'\n'
+    return line[:-1] if line.endswith(b'\n') else line
+
+
+def sort_chunk(chunk):
+    return sorted(chunk, key=line_sort_key)
+
+
+def iter_chunks(input_stream, chunk_size):
+    while True:
+        chunk = []
+        for line in input_stream:
+            assert line.endswith(b'\n')
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                break
+        if not chunk:
+            break
+        yield chunk
+
+
+def write_chunks(write_queue, temp_dir, temp_files, compression, errors):
+    temp_file_counter = count()
+    while True:
+        future = write_queue.get()
+        if future is None:
+            break
+        if errors:
+            # keep consuming the queue so that the reader does not get stuck
+            continue
+        try:
+            chunk = future.result()
+            temp_file_path = temp_dir / '{:06d}{}'.format(
+                next(temp_file_counter), temp_file_suffixes[compression])
+            temp_files.append(temp_file_path)
+            with open_temp_file_for_writing(temp_file_path, compression) as f:
+                f.writelines(chunk)
+            logger.debug('Written %d lines to %s', len(chunk), temp_file_path)
+        except BaseException as e:
+            logger.exception('Failed to write sorted chunk: %r', e)
+            errors.append(e)
+
+
+temp_file_suffixes = {
+    'zstd': '.zst',
+    'pigz': '.gz',
+    'gzip': '.gz',
+}
+
+
+def get_temp_compression(external=False):
+    # Preference is zstd, pigz, gzip; can be overridden by env variable
+    # SORT_TEMP_COMPRESSION=zstd|pigz|gzip. With external=True the result is
+    # used as GNU sort --compress-program, so zstd means the zstd command
+    # instead of the zstandard module.
+    def is_available(compression):
+        if compression == 'zstd':
+            return bool(shutil.which('zstd') if external else zstandard)
+        if compression == 'pigz':
+            return bool(shutil.which('pigz'))
+        return True
+
+    compression = os.environ.get('SORT_TEMP_COMPRESSION')
+    if compression:
+        if compression not in temp_file_suffixes:
+            raise Exception('Unknown SORT_TEMP_COMPRESSION: {!r}'.format(compression))
+        if not is_available(compression):
+            raise Exception('{} is not available for SORT_TEMP_COMPRESSION'.format(compression))
+        return compression
+    for compression in temp_file_suffixes:
+        if is_available(compression):
+            return compression
+
+
+@contextmanager
+def open_temp_file_for_writing(path, compression):
+    # temp files are deleted right after the merge, so use the fastest compression
+    if compression == 'zstd':
+        cctx = zstandard.ZstdCompressor(level=1, threads=-1)
+        with path.open(mode='wb') as raw:
+            with cctx.stream_writer(raw) as zf, BufferedWriter(zf, write_block_size) as f:
+                yield f
+        return
+    if compression == 'gzip':
+        # buffering avoids calling zlib for every small write
+        with gzip.open(path, mode='wb', compresslevel=1) as gz, BufferedWriter(gz, write_block_size) as f:
+            yield f
+        return
+    with path.open(mode='wb') as out:
+        p = subprocess.Popen([shutil.which('pigz'), '-1'], stdin=subprocess.PIPE, stdout=out)
+        try:
+            yield p.stdin
+        finally:
+            p.stdin.close()
+            rc = p.wait()
+        if rc != 0:
+            raise Exception('pigz failed with exit code {} writing {}'.format(rc, path))
+
+
+@contextmanager
+def open_temp_file_for_reading(path, compression):
+    if compression == 'zstd':
+        with path.open(mode='rb', buffering=read_block_size) as raw:
+            with zstandard.ZstdDecompressor().stream_reader(raw) as f:
+                yield f
+        return
+    if compression == 'gzip':
+        with path.open(mode='rb', buffering=read_block_size) as raw:
+            with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+                yield f
+        return
+    p = subprocess.Popen(
+        [shutil.which('pigz'), '-d', '-c', str(path)],
+        stdout=subprocess.PIPE, bufsize=read_block_size)
+    try:
+        yield p.stdout
+    finally:
+        p.stdout.close()
+        rc = p.wait()
+    if rc != 0:
+        raise Exception('pigz failed with exit code {} reading {}'.format(rc, path))
+
+
+read_block_size = 1 << 20
+write_block_size = 1 << 20
+
+
+def iter_lines(f, block_size=read_block_size):
+    # reading big blocks and splitting them in C is much cheaper than
+    # calling readline on GzipFile for every line
+    rest = b''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        end = block.rfind(b'\n') + 1
+        if not end:
+            rest += block
+            continue
+        yield from BytesIO(rest + block[:end])
+        rest = block[end:]
+    if rest:
+        yield rest
+
+
 def setup_logging():
     from logging import basicConfig, DEBUG
     basicConfig(level=DEBUG)
@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 import boto3
-from collections import Counter, namedtuple
-from datetime import datetime
-from functools import partial
+from collections import Counter
+from contextlib import contextmanager
 import gzip
+from io import BytesIO
 from logging import getLogger
+import mmap
 import multiprocessing
+import os
 from pathlib import Path
-import re
+from s3_log_parser import parse_line
+import shutil
+import signal
+import subprocess
 import sys
 
 
@@ -23,31 +28,61 @@ output_lock = multiprocessing.Lock()
 def main():
     p = ArgumentParser()
     p.add_argument('s3_log_path', nargs='+')
+    p.add_argument('--operation', action='append', dest='operations', type=operation_name,
+        help='count only this operation, e.g. REST.GET.OBJECT (can be repeated)')
     args = p.parse_args()
     setup_logging()
-    tasks = get_tasks(args.s3_log_path)
-    with multiprocessing.Pool() as pool:
-        results = []
-        for n, task in enumerate(tasks, start=1):
-            results.append(pool.apply_async(partial(task,
-                task_number=n,
-                task_count=len(tasks))))
-        for res in results:
-            res.get()
-
-
-def get_tasks(paths):
-    tasks = []
+    paths = get_paths(args.s3_log_path)
+    operations = frozenset(args.operations) if args.operations else None
+    # cheap substring check to skip lines with other operations before parsing
+    operation_needles = [b' %s ' % op.encode('ascii') for op in operations] if operations else None
+    tasks = [
+        (path, n, len(paths), operations, operation_needles)
+        for n, path in enumerate(paths, start=1)]
+    # stdin is not available in the pool worker processes
+    stdin_tasks = [t for t in tasks if t[0] == '-']
+    file_tasks = [t for t in tasks if t[0] != '-']
+    process_count = os.cpu_count() or 1
+    chunksize = max(1, len(file_tasks) // (process_count * 4))
+    totals = Counter()
+    with multiprocessing.Pool(process_count) as pool:
+        results = pool.imap_unordered(run_task, file_tasks, chunksize=chunksize)
+        for path, task_number, task_count, operations, operation_needles in stdin_tasks:
+            totals.update(process_stream(
+                sys.stdin.buffer, path=path,
+                task_number=task_number, task_count=task_count,
+                operations=operations, operation_needles=operation_needles))
+        for done_count, (path, counter) in enumerate(results, start=1):
+            logger.info('Finished %5d/%d files: %s', done_count, len(file_tasks), path)
+            totals.update(counter)
+    print_counts(totals)
+
+
+def operation_name(s):
+    if not s.isascii():
+        raise ArgumentTypeError('operation name must be ASCII: {!r}'.format(s))
+    return s
+
+
+def get_paths(paths):
+    result = []
     for p in paths:
         assert isinstance(p, str)
         if p == '-':
-            tasks.append(partial(process_stream, sys.stdin.buffer, path='-'))
+            result.append(p)
         elif p.startswith('s3://'):
             raise Exception('S3 URLs not supported yet')
         else:
-            for file_path in iter_file_paths(Path(p)):
-                tasks.append(partial(process_file, file_path))
-    return tasks
+            result.extend(iter_file_paths(Path(p)))
+    return result
+
+
+def run_task(task):
+    file_path, task_number, task_count, operations, operation_needles = task
+    counter = process_file(
+        file_path, task_number=task_number, task_count=task_count,
+        operations=operations, operation_needles=operation_needles)
+    return file_path, counter
 
 
 def iter_file_paths(p):
@@ -63,44 +98,106 @@ def iter_file_paths(p):
 def process_file(file_path, **kwargs):
     try:
         if file_path.name.endswith('.gz'):
-            with gzip.open(file_path, mode='rb') as f:
-                process_stream(f, path=file_path, **kwargs)
+            with open_gzip_file(file_path) as f:
+                return process_stream(f, path=file_path, **kwargs)
         else:
             with file_path.open(mode='rb') as f:
-                process_stream(f, path=file_path, **kwargs)
+                return process_stream(iter_mmap_lines(f), path=file_path, **kwargs)
     except Exception as e:
         logger.exception('Failed to process file %s: %r', file_path, e)
-
-
-def process_stream(stream, path, task_number, task_count):
+        return {}
+
+
+def iter_mmap_lines(f, chunk_size=8 << 20):
+    # splitting big chunks of a memory mapped file is cheaper than readline
+    size = os.fstat(f.fileno()).st_size
+    if not size:
+        # empty file cannot be mapped
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        pos = 0
+        while pos < size:
+            end = mm.find(b'\n', min(pos + chunk_size, size - 1))
+            end = size if end == -1 else end + 1
+            yield from BytesIO(mm[pos:end])
+            pos = end
+
+
+@contextmanager
+def open_gzip_file(file_path):
+    # igzip (ISA-L) and pigz decompress faster than the gzip module and
+    # they also run in parallel with the parsing
+    for name in ['igzip', 'pigz']:
+        command_path = shutil.which(name)
+        if command_path:
+            break
+    else:
+        with gzip.open(file_path, mode='rb') as f:
+            yield f
+        return
+    p = subprocess.Popen(
+        [command_path, '-d', '-c', str(file_path)],
+        stdout=subprocess.PIPE, bufsize=1 << 20)
+    try:
+        yield p.stdout
+    finally:
+        p.stdout.close()
+        rc = p.wait()
+    # SIGPIPE means that we have stopped reading early, that is already logged.
+    # Otherwise just log the error and keep the counts of what was read, the
+    # same as process_stream does with a truncated file read by gzip.open.
+    if rc not in (0, -signal.SIGPIPE):
+        logger.error('%s failed with exit code %s reading %s', name, rc, file_path)
+
+
+def process_stream(stream, path, task_number, task_count, operations=None, operation_needles=None):
+    # returns counts of (bucket, key, day, operation); they are merged and
+    # printed by the main process
+    counter = {}
     try:
         with output_lock:
             logger.info('Processing file %5d/%d: %s', task_number, task_count, path)
-        counter = Counter()
         for n, line in enumerate(stream, start=1):
-            assert isinstance(line, bytes)
             if n % 100000 == 0:
                 logger.info('Processed %9d lines', n)
             if line.startswith(b'#'):
                 continue
+            if operation_needles:
+                for needle in operation_needles:
+                    if needle in line:
+                        break
+                else:
+                    continue
             rec = parse_line(line)
-            k = (rec.bucket, rec.key, rec.date.strftime('%Y-%m-%d'), rec.operation)
-            counter[k] += 1
-            if len(counter) >= 1000000:
-                print_counts(counter)
-                counter = Counter()
-        if counter:
-            print_counts(counter)
+            if operations and rec.operation not in operations:
+                continue
+            k = (rec.bucket, rec.key, rec.day, rec.operation)
+            # plain dict is faster than Counter here
+            try:
+                counter[k] += 1
+            except KeyError:
+                counter[k] = 1
     except Exception as e:
         logger.exception('Failed to process stream %s: %r', path, e)
+    return counter
 
 
 def print_counts(counter):
-    with output_lock:
-        for k, n in counter.items():
-            bucket, key, day, operation = k
-            print('{} {} date={} operation={} count={}'.format(bucket, key, day, operation, n))
-            sys.stdout.flush()
+    # called only once in the main process, so no output_lock is needed
+    out = sys.stdout.buffer
+    buf = bytearray()
+    for k, n in counter.items():
+        bucket, key, day, operation = k
+        buf += b'%s %s date=%s operation=%s count=%d\n' % (
+            bucket.encode(), key.encode(), day.encode(), operation.encode(), n)
+        if len(buf) >= 1 << 20:
+            out.write(buf)
+            buf.clear()
+    if buf:
+        out.write(buf)
+    out.flush()
 
 
 def list_file_paths(p):
@@ -111,73 +208,6 @@ def list_file_paths(p):
             yield from list_file_paths(pp)
 
 
-re_line = re.compile(
-    rb'^[0-9a-f]+ ([^ ]+) \[([0-9A-Za-z:/ +-]+)\] [^ ]+ [^ ]+ [^ ]+ '
-    rb'([^ ]+) ([^ ]+)'
-    rb'.*'
-)
-
-
-Record = namedtuple('Record', 'bucket date operation key')
-
-
-def parse_line(line):
-    assert isinstance(line, bytes)
-    m = re_line.match(line)
-    if not m:
-        raise Exception('Invalid line format')
-    bucket, dt_str, operation, key = m.groups()
-    return Record(
-        bucket.decode('ascii'),
-        parse_date(dt_str),
-        operation.decode('ascii'),
-        key.decode('UTF-8'))
-
-
-re_date = re.compile(
-    rb'([0123][0-9])/([A-Z][a-z]{2})/([0-9]{4}):'
-    rb'([012][0-9]):([0-5][0-9]):([0-6][0-9]) ([+-])([0-9]{2})([0-9]{2})'
-)
-
-
-month_names = b'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()
-month_by_name = {name: n for n, name in enumerate(month_names, start=1)}
-assert month_by_name[b'Jan'] == 1
-assert month_by_name[b'Dec'] == 12
-
-
-def parse_date(dt_str):
-    assert isinstance(dt_str, bytes)
-    m = re_date.match(dt_str)
-    if not m:
-        raise Exception('Invalid date format: {!r}'.format(dt_str))
-    day, month_name, year, hour, minute, second, tz_sign, tz_hours, tz_minutes = m.groups()
-    if tz_hours != b'00' or tz_minutes != b'00':
-        # never happened, but just to be sure
-        raise Exception('Timezone support other than 0000 not yet implemented :/')
-    return datetime(
-        int(year), month_by_name[month_name], int(day),
-        int(hour), int(minute), int(second))
-
-
-sample_line = (
-    'c8f54323b37925ebe7617174b0e940623caad6e9e798e7f0dc55675743eb04c0 '
-    'edc-data-staging [03/May/2019:02:40:29 +0000] 94.130.17.190 - B9579B47C8F79A37 '
-    'REST.GET.OBJECT edc-s3-mock-data/Cases/ID002 '
-    '"GET /edc-data-staging/edc-s3-mock-data/Cases/ID002 HTTP/1.1" '
-    '200 - 1234 1234 16 15 "-" "python-requests/2.21.0" - '
-    'PwohJhVIBLoSRUrr+D9ElHt/av4XzO86zvIxp27mb5fFMWmKp0uon8DiSFHn63vmSalkc4ZWDdY= - '
-    'ECDHE-RSA-AES128-GCM-SHA256 - s3.eu-central-1.amazonaws.com TLSv1.2'
-)
-
-
-assert parse_line(sample_line.encode('ascii')) == Record(
-    bucket='edc-data-staging',
-    operation='REST.GET.OBJECT',
-    key='edc-s3-mock-data/Cases/ID002',
-    date=datetime(2019, 5, 3, 2, 40, 29))
-
-
 def setup_logging():
     from logging import basicConfig, getLogger, DEBUG, INFO
     basicConfig(format=log_format, level=DEBUG)